@@ -6,16 +6,19 @@ Script 4 of 5: Calculate Betting Statistics
 
 This script merges actual outcomes with predicted results to evaluate betting performance.
 It calculates overall and subset accuracies (e.g., home-favored vs. away-favored),
-and updates a combined CSV with the results.
+and updates the date-partitioned combined predictions (with a CSV export) with the results.
 
 Ensure "3_lightgbm_prediction.py" is executed before running this script.
 """
 
 import pandas as pd
 import os
+import shutil
+import functools
 import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
 import logging
-from datetime import timedelta
 
 # Import shared utilities
 from nba_utils import (
@@ -31,53 +34,88 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 # Maximum days to look back for files
 MAX_DAYS_BACK = 120  # Configurable range for searching files
 
-# Get current date information
-today, today_str, today_str_format = get_current_date()
-yesterday, yesterday_str, yesterday_str_format = get_current_date(days_offset=1)
-
-print(f"Today's date: {today_str_format}")
-print(f"Looking for data from: {yesterday_str_format}")
-print(yesterday)
-
-# Get directory paths
-paths = get_directory_paths()
-BASE_DIR = paths['BASE_DIR']
-DATA_DIR = paths['DATA_DIR']
-STAT_DIR = paths['STAT_DIR']
-target_folder = paths['NEXT_GAME_DIR']
-directory_path = paths['PREDICTION_DIR']
+# Columns and dtypes read from legacy combined CSV files (plus 'date', parsed as
+# datetime); numeric fields are read as strings because those files are parsed with
+# decimal="," and converted afterwards
+PRED_DTYPES = {
+    'home_team': 'category',
+    'away_team': 'category',
+    'home_team_prob': 'string',
+    'odds 1': 'string',
+    'odds 2': 'string',
+    'result': 'category'
+}
+
+# Arrow column types of the prediction files written by script 3, so numbers, dates
+# and team names are converted by the CSV parser itself
+PRED_ARROW_TYPES = {
+    'home_team': pa.dictionary(pa.int32(), pa.string()),
+    'away_team': pa.dictionary(pa.int32(), pa.string()),
+    'home_team_prob': pa.float64(),
+    'odds 1': pa.float64(),
+    'odds 2': pa.float64(),
+    'result': pa.dictionary(pa.int32(), pa.string()),
+    'date': pa.timestamp('ns')
+}
+
+# First day of the current season (NBA seasons tip off in October of the previous
+# calendar year); older predictions are not loaded
+SEASON_START = f"{CURRENT_SEASON - 1}-10-01"
+
+# Columns needed from the games statistics file
+STAT_COLUMNS = ['date', 'team', 'won', 'season']
+
+# Date-partitioned combined predictions store (one date=YYYY-MM-DD/part.parquet per
+# game day) and the schema of its files; 'date' is carried by the partition name and
+# the team columns are dictionary encoded, so they are read back as categoricals
+COMBINED_STORE = 'combined'
+STORE_SCHEMA = pa.schema([
+    ('home_team', pa.dictionary(pa.int32(), pa.string())),
+    ('away_team', pa.dictionary(pa.int32(), pa.string())),
+    ('home_team_prob', pa.float64()),
+    ('odds 1', pa.float64()),
+    ('odds 2', pa.float64()),
+    ('result', pa.dictionary(pa.int32(), pa.string())),
+    ('accuracy', pa.int8())
+])
+
+@functools.cache
+def _dates():
+    """Return today's and yesterday's date information, computed on first use."""
+    _, _, today_ymd = get_current_date()
+    yesterday, _, yesterday_ymd = get_current_date(days_offset=1)
+
+    return {
+        'today_ymd': today_ymd,
+        'yesterday': yesterday,
+        'yesterday_ymd': yesterday_ymd
+    }
+
+@functools.cache
+def _paths():
+    """Return the standard directory paths, resolved (and created) on first use."""
+    return get_directory_paths()
 
 def find_most_recent_prediction_file():
     """Find the most recent prediction file within the specified days range."""
-    days_back = 0
-    file_found = False
-
-    while not file_found and days_back <= MAX_DAYS_BACK:
-        # Recalculate the date string on every loop iteration
-        date_to_check = yesterday - timedelta(days=days_back)
-        date_str = date_to_check.strftime("%Y-%m-%d")
-
-        print(f"Checking date: {date_str}")
-
-        filename = f"nba_games_predict_{date_str}.csv"
-        file_path = os.path.join(directory_path, filename)
+    file_path, date_str = find_file_in_date_range(
+        _paths()['PREDICTION_DIR'],
+        "nba_games_predict_{}.csv",
+        MAX_DAYS_BACK,
+        reference_date=_dates()['yesterday']
+    )
 
-        if os.path.isfile(file_path):
-            file_found = True
-            print(f"The file for {date_str} exists.")
-            predict_file = [file_path]
-            last_prediction = date_str
-            return predict_file, last_prediction
-        else:
-            days_back += 1
+    if file_path:
+        logging.info("The file for %s exists.", date_str)
+        return [file_path], date_str
 
-    print("No file found in the last 120 days.")
+    logging.warning("No prediction file found in the last %d days.", MAX_DAYS_BACK)
     return None, None
 
 def find_most_recent_statistics_file():
     """Find the most recent statistics file within the specified days range."""
     file_path, date_str = find_file_in_date_range(
-        STAT_DIR,
+        _paths()['STAT_DIR'],
         f"nba_games_{{}}.csv",
         MAX_DAYS_BACK
     )
@@ -89,6 +127,107 @@ def find_most_recent_statistics_file():
         logging.warning("No statistics file found within the specified range.")
         return None
 
+def convert_decimal_commas(df, columns):
+    """
+    Convert columns that may use a comma as decimal separator to float, in place.
+
+    Args:
+        df (DataFrame): DataFrame to convert
+        columns (iterable): Names of the columns to convert
+    """
+    for col in columns:
+        values = df[col]
+        if not pd.api.types.is_numeric_dtype(values):
+            values = values.str.replace(',', '.', regex=False)
+        df[col] = pd.to_numeric(values, errors='coerce').astype(np.float64)
+
+def to_shared_categories(frames, columns):
+    """
+    Cast columns of one or more DataFrames to one categorical dtype, in place, so they
+    can be concatenated without falling back to object and compared by codes.
+
+    Columns that are already categorical only contribute their (about 30) categories,
+    so the values themselves are never hashed again.
+
+    Args:
+        frames (list): DataFrames to convert; columns missing from a frame are skipped
+        columns (iterable): Names of the columns sharing the categories
+    """
+    categoricals = {}
+    for i, df in enumerate(frames):
+        for col in columns:
+            if col in df:
+                categoricals[i, col] = df[col].astype('category')
+
+    categories = pd.Index([], dtype=object)
+    for values in categoricals.values():
+        categories = categories.union(values.cat.categories)
+
+    for (i, col), values in categoricals.items():
+        frames[i][col] = values.cat.set_categories(categories)
+
+def write_combined_partitions(df, dates):
+    """
+    Write the rows of the given game days to the combined predictions store.
+
+    Each day is written to its own partition, replacing it if it exists, so the
+    rest of the history is never rewritten. A given day without rows left has its
+    partition removed, so stale rows are not read back.
+
+    Args:
+        df (DataFrame): Combined predictions with results and accuracy
+        dates (set): Date strings (YYYY-MM-DD) of the partitions to write
+    """
+    store_path = os.path.join(_paths()['PREDICTION_DIR'], COMBINED_STORE)
+    day = df['date'].dt.strftime('%Y-%m-%d')
+
+    for date_str, partition_df in df[day.isin(dates)].groupby(day):
+        partition_path = os.path.join(store_path, f'date={date_str}')
+        os.makedirs(partition_path, exist_ok=True)
+        partition_df.drop(columns='date').to_parquet(
+            os.path.join(partition_path, 'part.parquet'),
+            engine='pyarrow', compression='zstd', schema=STORE_SCHEMA, index=False
+        )
+
+    for date_str in set(dates) - set(day.dropna()):
+        shutil.rmtree(os.path.join(store_path, f'date={date_str}'), ignore_errors=True)
+
+def read_combined_store(columns, filters):
+    """
+    Read game days from the combined predictions store, newest day first.
+
+    Args:
+        columns (list): Columns to read, including 'date'
+        filters (list): Partition filters on 'date', e.g. [('date', '>=', SEASON_START)]
+
+    Returns:
+        DataFrame: Rows of the selected game days
+    """
+    store_path = os.path.join(_paths()['PREDICTION_DIR'], COMBINED_STORE)
+    df = pd.read_parquet(store_path, columns=columns, filters=filters)
+    df['date'] = pd.to_datetime(df['date'].astype(str))
+    return df.sort_values(by='date', ascending=False, kind='stable')
+
+def import_legacy_combined_csv(legacy_file_path):
+    """
+    Convert a combined predictions CSV from before the Parquet store into the store.
+
+    This is the only place the utf-7 encoded CSV history is decoded; later runs
+    read the binary store instead. Every row is imported, since the store becomes the
+    only copy of the history; the season cut is applied when the store is read.
+
+    Args:
+        legacy_file_path (str): Path to the combined predictions CSV
+    """
+    legacy_df = pd.read_csv(
+        legacy_file_path, encoding="utf-7", decimal=",",
+        usecols=[*PRED_DTYPES, 'date', 'accuracy'], dtype=PRED_DTYPES, parse_dates=['date']
+    )
+    convert_decimal_commas(legacy_df, ('home_team_prob', 'odds 1', 'odds 2'))
+
+    write_combined_partitions(legacy_df, set(legacy_df['date'].dt.strftime('%Y-%m-%d').dropna()))
+    logging.info(f"Imported {len(legacy_df)} rows from {legacy_file_path} into the combined store.")
+
 def process_prediction_file(predict_file, last_prediction):
     """
     Process the prediction file and update the combined predictions.
@@ -104,32 +243,37 @@ def process_prediction_file(predict_file, last_prediction):
         print(f"No prediction file found.")
         return None
 
-    # Read prediction file
-    predict_file_df = pd.read_csv(predict_file[0], encoding="utf-7", decimal=",")
+    # Read prediction file (written as UTF-8 by script 3) with the Arrow CSV reader
+    convert_options = pacsv.ConvertOptions(column_types=PRED_ARROW_TYPES, include_columns=list(PRED_ARROW_TYPES))
+    predict_file_df = pacsv.read_csv(predict_file[0], convert_options=convert_options).to_pandas()
 
     # Columns to display
-    columns_to_display = ['home_team', 'away_team', 'home_team_prob', 'odds 1', 'odds 2', 'result', 'date']
-
-    # Convert 'odds 1' and 'odds 2' from comma as decimal separator to period
-    predict_file_df['odds 1'] = predict_file_df['odds 1'].astype(str).str.replace(',', '.').astype(float)
-    predict_file_df['odds 2'] = predict_file_df['odds 2'].astype(str).str.replace(',', '.').astype(float)
-
-    # File path for combined data
-    combined_file_path = os.path.join(directory_path, f'combined_nba_predictions_acc_{last_prediction}.csv')
-
-    try:
-        # Attempt to read the combined file
-        combined_df = pd.read_csv(combined_file_path, encoding="utf-7", decimal=",")
-    except FileNotFoundError:
+    columns_to_display = [*PRED_DTYPES, 'date']
+
+    # Combined data lives in the partitioned store; a CSV history written before the
+    # store existed is converted into it once
+    directory_path = _paths()['PREDICTION_DIR']
+    store_path = os.path.join(directory_path, COMBINED_STORE)
+    legacy_file_path = os.path.join(directory_path, f'combined_nba_predictions_acc_{last_prediction}.csv')
+
+    if not os.path.isdir(store_path) and os.path.isfile(legacy_file_path):
+        import_legacy_combined_csv(legacy_file_path)
+
+    if os.path.isdir(store_path):
+        # Only read current-season partitions, skipping the one the prediction file
+        # replaces; newest day first
+        combined_df = read_combined_store(
+            columns_to_display, [('date', '>=', SEASON_START), ('date', '!=', last_prediction)]
+        )
+    else:
         # If not found, initialize an empty DataFrame
         combined_df = pd.DataFrame()
 
-    # Append new data to the combined DataFrame
+    # Prepend new data to the combined DataFrame; the history is stored newest first
+    # and the prediction file holds the latest date, so no re-sort is needed
     predict_file_df['accuracy'] = np.nan  # Add 'accuracy' column with NaN
-    combined_df = pd.concat([combined_df, predict_file_df], ignore_index=True)
-
-    # Sort the DataFrame by date
-    combined_df = combined_df.sort_values(by='date', ascending=False)
+    to_shared_categories([predict_file_df, combined_df], ('home_team', 'away_team', 'result'))
+    combined_df = pd.concat([predict_file_df, combined_df], ignore_index=True)
 
     # Select only the desired columns
     combined_df = combined_df[columns_to_display]
@@ -138,44 +282,59 @@ def process_prediction_file(predict_file, last_prediction):
     print(f"Combined predictions updated")
     return combined_df
 
-def update_betting_statistics(combined_df, most_recent_date):
+def update_betting_statistics(combined_df, most_recent_date, last_prediction):
     """
     Update betting statistics with actual game results.
 
     Args:
-        combined_df (DataFrame): DataFrame with combined predictions
+        combined_df (DataFrame): DataFrame with combined predictions, updated in place
         most_recent_date (str): Date string of the most recent statistics file
+        last_prediction (str): Date string of the prediction file merged into combined_df
 
     Returns:
         DataFrame: Updated statistics DataFrame or None if update failed
     """
-    # Make a copy of the combined DataFrame
-    season_2025_df = combined_df.copy()
+    # The combined DataFrame is not reused by the caller, so update it without a copy
+    season_2025_df = combined_df
 
-    print(most_recent_date)
+    logging.debug("Reading game results from the statistics file of %s", most_recent_date)
 
     # Read the most recent games data
-    daily_games_df = pd.read_csv(os.path.join(STAT_DIR, f"nba_games_{most_recent_date}.csv"))
-
-    # Filter data for the current season
-    daily_games_df = daily_games_df[daily_games_df['season'] == CURRENT_SEASON].copy()
-
-    # Convert dates to datetime
-    season_2025_df['date'] = pd.to_datetime(season_2025_df['date'], errors='coerce')
-    daily_games_df['date'] = pd.to_datetime(daily_games_df['date'], errors='coerce')
-
-    # Iterate over each row in the daily game data and update the result column
-    for _, row in daily_games_df.iterrows():
-        date = row['date']
-        winning_team = row['team'] if row['won'] == 1 else None
-
-        # Update the 'result' column for the corresponding date and teams
-        if winning_team:
-            mask = (season_2025_df['date'] == date) & (
-                (season_2025_df['home_team'] == winning_team) | (season_2025_df['away_team'] == winning_team)
-            )
-
-            season_2025_df.loc[mask, 'result'] = winning_team
+    daily_games_df = pd.read_csv(os.path.join(_paths()['STAT_DIR'], f"nba_games_{most_recent_date}.csv"), usecols=STAT_COLUMNS)
+
+    # Winning team per game of the current season, as (date, team) lookup keys; both
+    # filters are applied in a single mask before any column is converted
+    is_winner = (daily_games_df['season'] == CURRENT_SEASON) & (daily_games_df['won'] == 1)
+    winners = daily_games_df.loc[is_winner, ['date', 'team']]
+    winner_keys = pd.MultiIndex.from_arrays([pd.to_datetime(winners['date'], errors='coerce'), winners['team']])
+
+    # Look up both sides of each game; games sharing a date stay distinct by team and
+    # every row is matched on its own, so repeated games need no sequential pass
+    home_won = pd.MultiIndex.from_arrays([season_2025_df['date'], season_2025_df['home_team']]).isin(winner_keys)
+    away_won = pd.MultiIndex.from_arrays([season_2025_df['date'], season_2025_df['away_team']]).isin(winner_keys)
+
+    # Share one set of team categories so equality is an integer compare on the codes;
+    # missing values stay missing (code -1) instead of becoming the string "nan"
+    to_shared_categories([season_2025_df], ('home_team', 'away_team', 'result'))
+    team_dtype = season_2025_df['result'].dtype
+    home_team = season_2025_df['home_team'].cat.codes.to_numpy()
+    away_team = season_2025_df['away_team'].cat.codes.to_numpy()
+
+    # Update the 'result' column where a winner was found, working on the codes
+    previous_result = season_2025_df['result'].cat.codes.to_numpy()
+    result = np.where(home_won, home_team, np.where(away_won, away_team, previous_result))
+    season_2025_df['result'] = pd.Categorical.from_codes(result, dtype=team_dtype)
+
+    # Game days whose stored partition is missing or out of date; the prediction
+    # file's day was skipped when reading the store, so it is always rewritten
+    directory_path = _paths()['PREDICTION_DIR']
+    store_path = os.path.join(directory_path, COMBINED_STORE)
+    stored_dates = {
+        name[len('date='):] for name in os.listdir(store_path) if name.startswith('date=')
+    } if os.path.isdir(store_path) else set()
+    day = season_2025_df['date'].dt.strftime('%Y-%m-%d')
+    result_changed = (home_won | away_won) & (result != previous_result)
+    changed_dates = set(day[result_changed].dropna()) | (set(day.dropna()) - stored_dates) | {last_prediction}
 
     # Ensure that 'home_team_prob' is numeric
     season_2025_df['home_team_prob'] = pd.to_numeric(season_2025_df['home_team_prob'], errors='coerce')
@@ -184,48 +343,58 @@ def update_betting_statistics(combined_df, most_recent_date):
     if season_2025_df['home_team_prob'].isnull().any():
         print("Warning: Some values in 'home_team_prob' could not be converted to numeric and have been set to NaN.")
 
-    # Ensure 'result', 'home_team', and 'away_team' columns are strings for comparison
-    season_2025_df['result'] = season_2025_df['result'].astype(str)
-    season_2025_df['home_team'] = season_2025_df['home_team'].astype(str)
-    season_2025_df['away_team'] = season_2025_df['away_team'].astype(str)
-
-    # Create conditions for correct predictions
-    home_team_correct = (season_2025_df['home_team_prob'] >= 0.5) & (season_2025_df['result'] == season_2025_df['home_team'])
-    away_team_correct = (season_2025_df['home_team_prob'] < 0.5) & (season_2025_df['result'] == season_2025_df['away_team'])
+    # Create conditions for correct predictions on the raw arrays
+    prob = season_2025_df['home_team_prob'].to_numpy()
+    correct = (result >= 0) & (((prob >= 0.5) & (result == home_team)) | ((prob < 0.5) & (result == away_team)))
 
-    # Calculate accuracy for each row
-    season_2025_df['accuracy'] = (home_team_correct | away_team_correct).astype(int)
+    # Calculate accuracy for each row (bool and int8 share a width, so no copy)
+    season_2025_df['accuracy'] = correct.view(np.int8)
 
     # Overall Accuracy
     overall_accuracy = season_2025_df['accuracy'].mean()
     print(f'Overall Accuracy: {overall_accuracy:.2%}')
 
-    # Filter the DataFrame for specific subsets
-    subset_df = season_2025_df[(season_2025_df['home_team_prob'] <= 0.400)]
-    subset_df_home = season_2025_df[(season_2025_df['home_team_prob'] > 0.6)]
+    # Bucket the predictions by home win probability and average each bucket in one pass
+    prob_bucket = pd.cut(
+        season_2025_df['home_team_prob'], [0, 0.4, 0.6, 1.0],
+        labels=['away_fav', 'neutral', 'home_fav'], include_lowest=True
+    )
+    accuracy_by_bucket = season_2025_df['accuracy'].groupby(prob_bucket, observed=False).mean()
 
-    # Calculate accuracy for the subsets
-    subset_accuracy = subset_df['accuracy'].mean()
-    subset_accuracy_home = subset_df_home['accuracy'].mean()
+    # Accuracy for the subsets
+    subset_accuracy = accuracy_by_bucket['away_fav']
+    subset_accuracy_home = accuracy_by_bucket['home_fav']
 
     print(f'Accuracy for home_team_prob above 0.60: {subset_accuracy_home:.2%}')
     print(f'Accuracy for home_team_prob under 0.40 (away team wins): {subset_accuracy:.2%}')
 
     # Save the updated DataFrame
-    save_file_path = os.path.join(directory_path, f'combined_nba_predictions_acc_{today_str_format}.csv')
-    print(save_file_path)
+    export_file_path = os.path.join(directory_path, f"combined_nba_predictions_acc_{_dates()['today_ymd']}.csv")
+    print(export_file_path)
 
     # Drop unnecessary columns if they exist
     season_2025_df.drop(columns=['Unnamed: 8'], errors='ignore', inplace=True)
-    season_2025_df.dropna(inplace=True)
 
-    # Save the final DataFrame
-    season_2025_df.to_csv(save_file_path, index=False)
+    # Drop rows missing a value the statistics depend on; missing odds are kept
+    season_2025_df.dropna(subset=['home_team_prob', 'result', 'home_team', 'away_team', 'date'], inplace=True)
+
+    # Save the changed game days, with a full CSV export for script 5 and manual inspection;
+    # the export also carries the earlier seasons, which are only read back for it
+    write_combined_partitions(season_2025_df, changed_dates)
+    export_df = season_2025_df
+    if os.path.isdir(store_path):
+        earlier_seasons_df = read_combined_store(list(season_2025_df.columns), [('date', '<', SEASON_START)])
+        if not earlier_seasons_df.empty:
+            export_df = pd.concat([season_2025_df, earlier_seasons_df], ignore_index=True)
+    export_df.to_csv(export_file_path, index=False)
 
     return season_2025_df
 
 def main():
     """Main execution function."""
+    logging.debug("Today's date: %s", _dates()['today_ymd'])
+    logging.debug("Looking for data from: %s", _dates()['yesterday_ymd'])
+
     # Find the most recent prediction file
     predict_file, last_prediction = find_most_recent_prediction_file()
 
@@ -239,7 +408,7 @@ def main():
 
             if most_recent_date:
                 # Update betting statistics
-                updated_df = update_betting_statistics(combined_df, most_recent_date)
+                updated_df = update_betting_statistics(combined_df, most_recent_date, last_prediction)
 
                 if updated_df is not None:
                     print("Betting statistics updated successfully.")
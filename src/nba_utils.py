@@ -9,6 +9,7 @@ across the NBA prediction scripts.
 """
 
 import os
+import re
 import glob
 import pandas as pd
 import numpy as np
@@ -139,26 +140,50 @@ def get_latest_file(folder, prefix, ext):
     files = glob.glob(os.path.join(folder, f"{prefix}*{ext}"))
     return max(files, key=os.path.getctime) if files else None
 
-def find_file_in_date_range(directory, filename_pattern, max_days_back=120):
+def find_file_in_date_range(directory, filename_pattern, max_days_back=120, reference_date=None):
     """
-    Find a file matching the pattern within a specified number of days back.
+    Find the most recent file matching the pattern within a specified number of days back.
+
+    The directory is listed once and the date is parsed from each matching file name,
+    instead of probing one candidate path per day.
 
     Args:
         directory (str): Directory to search
         filename_pattern (str): Pattern with {} placeholder for date
         max_days_back (int): Maximum number of days to look back
+        reference_date (datetime): Date to count back from (defaults to now)
 
     Returns:
         tuple: (file_path, date_str) or (None, None) if not found
     """
-    for days_back in range(max_days_back + 1):
-        date_to_check = (datetime.now() - timedelta(days=days_back)).strftime("%Y-%m-%d")
-        file_path = os.path.join(directory, filename_pattern.format(date_to_check))
-
-        if os.path.exists(file_path):
-            return file_path, date_to_check
+    reference_date = (reference_date or datetime.now()).date()
+    prefix, suffix = filename_pattern.split("{}")
+    pattern = re.compile(re.escape(prefix) + r"(\d{4}-\d{2}-\d{2})" + re.escape(suffix) + "$")
 
-    return None, None
+    best_path, best_date = None, None
+    try:
+        entries = os.scandir(directory)
+    except FileNotFoundError:
+        return None, None
+
+    with entries:
+        for entry in entries:
+            match = pattern.match(entry.name)
+            if not match or not entry.is_file():
+                continue
+            try:
+                file_date = datetime.strptime(match.group(1), "%Y-%m-%d").date()
+            except ValueError:
+                continue
+            if not 0 <= (reference_date - file_date).days <= max_days_back:
+                continue
+            if best_date is None or file_date > best_date:
+                best_path, best_date = entry.path, file_date
+
+    if best_path is None:
+        return None, None
+
+    return best_path, best_date.strftime("%Y-%m-%d")
 
 def copy_missing_files(src_dir, dst_dir):
     """